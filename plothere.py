@@ -1,11 +1,40 @@
 import numpy as np 
+from bisect import bisect_right
+from functools import lru_cache
+from urllib.parse import urlencode
 import cartopy.crs as ccrs
-import flexpolyline as fp
-from matplotlib import cm 
+from matplotlib import cm, rcParams
 from matplotlib.path import Path
-from matplotlib.patches import PathPatch
+from matplotlib.patches import Patch
+from matplotlib.collections import PathCollection
 
 
+# Conversion factors from each accepted unit to seconds (time) or meters (distance)
+_TO_BASE = {'s':1, 'seconds':1,
+            'min':60, 'minutes':60,
+            'hours':60*60, 'h':60*60,
+            'm':1, 'meters':1,
+            'km':1000, 'kilometers':1000, 'kms':1000,
+            'ft':0.3048, 'feet':0.3048, 'foot':0.3048,
+            'yard':0.9144, 'yrd':0.9144, 'yards':0.9144,
+            'mile':1609.344, 'miles':1609.344, 'mi':1609.344, 'mls':1609.344}
+
+_TIME_UNITS = frozenset(['s','seconds','min','minutes','hours','h'])
+
+# Query keys for the isoline origin and time, indexed by the reverse flag of here_isoline_request
+_REQUEST_KEYS = (('origin', 'departureTime'), ('destination', 'arrivalTime'))
+
+# Shared CRS instances, building a CRS constructs pyproj objects which is slow
+_GEODETIC = ccrs.Geodetic()
+_PLATE_CARREE = ccrs.PlateCarree()
+
+# Leading digits allowed for automatic scalebar lengths
+_NICE_STEPS = (1, 2, 5, 10)
+
+# Maps ascii codes of the flexible polyline alphabet to their 6 bit values, -1 for invalid characters
+_FP_DECODING_TABLE = np.full(256, -1, dtype=np.int64)
+_FP_DECODING_TABLE[np.frombuffer(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_', dtype=np.uint8)] = np.arange(64)
+
 
 def here_geocode_request(search,apiKey, limit=1):
     ''' Create a Here geocoding API request for a given search string. 
@@ -28,76 +57,129 @@ def here_isoline_request(origin_point, transport_mode, range_values, range_type,
     transportMode: 'car' etc. (See here documentation for full list)
     range_values: float or list of ranges for isolines
     range_type: 'time' or 'distance'
-    apiKey: your private Here API key
-    departure_time: departure time for traffic calculation. If False, traffic ignored.
+    apiKey: your private Here API key (with or without a leading '=')
+    departure_time: departure time for traffic calculation. If False or None, traffic ignored.
     reverse: if true, the origin point will be treated as a destination.
     '''
     
     url = "https://isoline.router.hereapi.com/v8/isolines?"
-    origin='origin'
-    depature='departureTime'
-    if reverse:
-        origin='destination'
-        depature = 'arrivalTime'
-        
-    url = (url+
-               'apiKey'+apiKey+
-               '&transportMode='+transport_mode+
-               '&'+origin+'='+str(origin_point[0])+','+str(origin_point[1])+
-               '&range[type]='+range_type+
-               '&range[values]=')
-    
-    values = ''
-    try:
-        for r in range_values:
-            values+=str(r)+','
-    except:
-        values+=str(range_values)+','
-        
-    url += values[:-1]
+    origin, depature = _REQUEST_KEYS[bool(reverse)]
     
-    if departure_time!=False:
-        url += '&'+depature+'='+departure_time
+    if not np.iterable(range_values):
+        range_values = [range_values]
     
-    return url
+    params = {'apiKey': apiKey[1:] if apiKey.startswith('=') else apiKey,
+              'transportMode': transport_mode,
+              origin: str(origin_point[0])+','+str(origin_point[1]),
+              'range[type]': range_type,
+              'range[values]': ','.join(map(str, range_values))}
+    
+    if departure_time:
+        params[depature] = departure_time
+    
+    return url+urlencode(params, safe=',[]:')
 
 def here_isolines_to_WGS84(here_response):
     '''
-    Converts compressed flexible polygon response from the Here isoline API to lat-lon coords.
+    Converts compressed flexible polygon response from the Here isoline API to lon-lat coords (column 0 is longitude; earlier versions returned lat-lon).
+    Returns a dict in the form of {range: np.array with columns containing longitude and latitude coords}
     '''
     
     isolines={}
     for iso in here_response['isolines']:
-        coords = np.array(list(p for p in fp.iter_decode(iso['polygons'][0]['outer'])))
+        coords = _decode_flexpolyline(iso['polygons'][0]['outer'])
         value = iso['range']['value']
         isolines[value]=coords
     
     return isolines
 
+def _decode_flexpolyline(encoded):
+    '''
+    Decodes a HERE flexible polyline string to an array with columns of longitude and latitude coords.
+    Vectorised equivalent of flexpolyline.iter_decode, any third dimension is dropped.
+    encoded: flexible polyline string
+    '''
+    
+    try:
+        encoded = encoded.encode('ascii')
+    except UnicodeEncodeError:
+        raise ValueError('Invalid encoding') from None
+    
+    chars = _FP_DECODING_TABLE[np.frombuffer(encoded, dtype=np.uint8)]
+    if (chars < 0).any():
+        raise ValueError('Invalid encoding')
+    
+    # Each unsigned value is a run of 5 bit chunks, least significant first, with bit 0x20 set on all but the last
+    ends = np.flatnonzero((chars & 0x20) == 0)
+    if len(ends) < 2 or ends[-1] != len(chars)-1:
+        raise ValueError('Invalid encoding')
+    starts = np.concatenate(([0], ends[:-1]+1))
+    lengths = ends-starts+1
+    # 12 chunks is 60 bits, any longer value would overflow the int64 shifts below
+    if lengths.max() > 12:
+        raise ValueError('Invalid encoding. Value too large')
+    shifts = 5*(np.arange(len(chars)) - np.repeat(starts, lengths))
+    unsigned = np.add.reduceat((chars & 0x1F) << shifts, starts)
+    
+    # Header: format version, then precision and third dimension type
+    if unsigned[0] != 1:
+        raise ValueError('Invalid format version')
+    precision = unsigned[1] & 15
+    dims = 3 if (unsigned[1] >> 4) & 7 else 2
+    
+    deltas = unsigned[2:]
+    if len(deltas) % dims:
+        raise ValueError('Invalid encoding. Premature ending reached')
+    
+    # Undo the zigzag sign encoding in place
+    sign = -(deltas & 1)
+    deltas >>= 1
+    deltas ^= sign
+    
+    # Accumulate the integer deltas in place (a float accumulator would round above 2**53),
+    # then scale the columns in lon/lat order straight into the output, points are encoded lat first
+    points = deltas.reshape(-1, dims)
+    np.cumsum(points, axis=0, out=points)
+    coords = np.empty((len(points), 2))
+    np.divide(points[:,1::-1], 10.0**precision, out=coords)
+    
+    return coords
+
 def find_extent(all_poly, buffer=0.1):
     '''
     Creates a extent around a given set of polygons with a buffer.
-    all_poly: list of np.arrays with columns containing longitude and latitude coords.
+    all_poly: list of np.arrays with columns containing longitude and latitude coords,
+              or a dict of nested isolines in the form of {range: polygon coords (lon/lat)}, in which case only the largest range is scanned.
     buffer: ratio of blank space to allow on border of map, as a ratio of the length of the polygon in lat/lon
     '''
     
-    lon_max = -np.inf
-    lon_min = np.inf
-    lat_max = -np.inf 
-    lat_min = np.inf 
-    
-    for Poly in all_poly:
-        if np.max(Poly[:,0])>lon_max:
-            lon_max=np.max(Poly[:,0])
-        if np.min(Poly[:,0])<lon_min:
-            lon_min = np.min(Poly[:,0])
-        if np.max(Poly[:,1])>lat_max:
-            lat_max = np.max(Poly[:,1])
-        if np.min(Poly[:,1])<lat_min:
-            lat_min=np.min(Poly[:,1])
+    if isinstance(all_poly, dict):
+        return find_extent_from_largest(all_poly[max(all_poly)], buffer)
+    
+    return _extent(np.concatenate(all_poly, axis=0), buffer)
+
+def find_extent_from_largest(poly, buffer=0.1):
+    '''
+    Creates a extent around the largest of a set of nested polygons (e.g. isolines) with a buffer.
+    The largest polygon contains all the others, so its extent is the extent of the whole set.
+    poly: np.array with columns containing longitude and latitude coords.
+    buffer: ratio of blank space to allow on border of map, as a ratio of the length of the polygon in lat/lon
+    '''
+    
+    return _extent(poly, buffer)
+
+def _extent(poly, buffer):
+    '''
+    Creates a extent around the coords of a single array with a buffer.
+    poly: np.array with columns containing longitude and latitude coords.
+    buffer: ratio of blank space to allow on border of map, as a ratio of the length of the polygon in lat/lon
+    '''
+    
+    lon_min, lat_min = poly.min(axis=0)
+    lon_max, lat_max = poly.max(axis=0)
                 
     lon_buffer = abs(lon_max-lon_min)*buffer
-    lat_buffer = abs(lon_max-lon_min)*buffer
+    lat_buffer = abs(lat_max-lat_min)*buffer
     
     top = lon_max+lon_buffer
     bottom = lon_min-lon_buffer
@@ -110,7 +192,7 @@ def plot_isolines(isolines, ax, cmap=cm.get_cmap('viridis'), units='seconds', ax
     
     ''' 
     Plots isolines from HERE API onto matplotlib GeoAxes. Ensures that the larger isolines are not overlapping the smaller ones for plotting clarity.
-    isolines: a dict in the form of {range: polygon coords (lat/lon)}
+    isolines: a dict in the form of {range: polygon coords (lon/lat)}, as returned by here_isolines_to_WGS84
     ax: matplotlib GeoAxesSubplot
     cmap: matplotlib colormap
     units: isoline native range units (string)
@@ -119,91 +201,84 @@ def plot_isolines(isolines, ax, cmap=cm.get_cmap('viridis'), units='seconds', ax
     contour_lines: linewidth of contour lines. Set to 0 for no lines.
     alpha: opacity of the plotted polygons.
     
+    Returns a list of legend handles, one per isoline, to pass as ax.legend(handles=...).
+    The isolines are drawn as a single collection which legend loc='best' does not avoid, so give an explicit loc.
     '''
     
     
     # get isoline ranges 
     ranges = list(isolines.keys())
     
-    # Get polygons into list with lon/lat format
-    polygons = [np.hstack((np.vstack(isolines[value][:,1]), np.vstack(isolines[value][:,0]))) for value in ranges]
-    
-    get_c = lambda i, n: 1-(1/(n))*i-(1/(2*n))
+    # Get polygons into list
+    polygons = [isolines[value] for value in ranges]
     
     # Check for formatting correctness.
-    if units not in ['s','seconds','min','minutes','hours','h','m','meters','km','kilometers','kms','ft','feet','foot','yard','yrd','yards','mile','miles', 'mi', 'mls']:
+    if units not in _TO_BASE:
         print("Incorrect isoline unit specification, please ensure it is one of: 's','seconds','min','minutes','hours','h','m','meters','km','kilometers','kms','ft','feet','foot','yard','yrd','yards','mile','miles', 'mi', 'mls'")
         return None
-    if ax_units not in ['s','seconds','min','minutes','hours','h','m','meters','km','kilometers','kms','ft','feet','foot','yard','yrd','yards','mile','miles', 'mi', 'mls']:
+    if ax_units not in _TO_BASE:
         print("Incorrect axis unit specification, please ensure it is one of: 's','seconds','min','minutes','hours','h','m','meters','km','kilometers','kms','ft','feet','foot','yard','yrd','yards','mile','miles', 'mi', 'mls'")
         return None
-    if (units in ['s','seconds','min','minutes','hours','h']) and (ax_units in ['m','meters','km','kilometers','kms','ft','feet','foot','yard','yrd','yards','mile','miles', 'mi', 'mls']):
+    if (units in _TIME_UNITS) and (ax_units not in _TIME_UNITS):
         print('Incompatible isoline and axis units (time and distance respectively).')
         return None
-    if (units not in ['s','seconds','min','minutes','hours','h']) and (ax_units not in ['m','meters','km','kilometers','kms','ft','feet','foot','yard','yrd','yards','mile','miles', 'mi', 'mls']):
+    if (units not in _TIME_UNITS) and (ax_units in _TIME_UNITS):
         print('Incompatible isoline and axis units (distance and time respectively).')
         return None
     
     # Convert units
-    if units.lower() in ['s','seconds']:
-        values = np.array(ranges)
-    elif units.lower() in ['min','minutes']:
-        values = np.array(ranges)*60
-    elif units.lower() in ['hours','h']:
-        values = np.array(ranges)*60*60
-    elif units.lower() in ['m', 'meters']:
-        values = np.array(ranges)
-    elif units.lower() in ['km', 'kilometers','kms']:
-        values = np.array(ranges)*1000
-    elif units.lower() in ['ft','feet','foot']:
-        values = np.array(ranges)*0.3048
-    elif units.lower() in ['yard','yrd','yards']:
-        values = np.array(ranges)*0.9144
-    elif units.lower() in ['mile','miles', 'mi', 'mls']:
-        values = np.array(ranges)*1609.344
-
-    if ax_units.lower() in ['s','seconds']:
-        values = values
-    elif ax_units.lower() in ['min','minutes']:
-        values = values/60
-    elif ax_units.lower() in ['hours','h']:
-        values = values/(60*60)
-    elif ax_units.lower() in ['m', 'meters']:
-        values = values
-    elif ax_units.lower() in ['km', 'kilometers','kms']:
-        values = values/1000
-    elif ax_units.lower() in ['ft','feet','foot']:
-        values = values/0.3048
-    elif ax_units.lower() in ['yard','yrd','yards']:
-        values = values/0.9144
-    elif ax_units.lower() in ['mile','miles', 'mi', 'mls']:
-        values = values/1609.344
+    values = np.asarray(ranges)*_TO_BASE[units.lower()]/_TO_BASE[ax_units.lower()]
         
-    # Plot isolines
+    # Build isoline paths, hollowing out each one by the isoline inside it
+    paths = []
+    labels = []
     for i in range(len(polygons)):
         if i == 0:
             
-            poly_C = [Path.LINETO for p in polygons[i]]
-            poly_C[0] = Path.MOVETO
-            codes = []
+            codes = np.full(len(polygons[i]), Path.LINETO, dtype=Path.code_type)
+            codes[0] = Path.MOVETO
             
-            codes.extend(poly_C)
-            ax.add_patch(PathPatch(Path(polygons[i],codes),
-                                          lw=contour_lines,
-                                          facecolor=cmap(get_c(i,len(ranges))), 
-                                          transform=ccrs.Geodetic(),
-                                          alpha=alpha,
-                                          label=str(round(0.0,label_rounding))+'-'+str(round(values[i],label_rounding))+' '+ax_units))
+            paths.append(Path(polygons[i],codes))
+            labels.append(str(round(0.0,label_rounding))+'-'+str(round(values[i],label_rounding))+' '+ax_units)
         else:
-            path = patch_between(polygons[i], polygons[i-1])
-            ax.add_patch(PathPatch(path, 
-                                   facecolor=cmap(get_c(i,len(ranges))), 
-                                   lw=contour_lines,
-                                   transform=ccrs.Geodetic(),
-                                   alpha=alpha,
-                                   label=str(round(values[i-1],label_rounding))+'-'+str(round(values[i],label_rounding))+' '+ax_units))
+            paths.append(patch_between(polygons[i], polygons[i-1]))
+            labels.append(str(round(values[i-1],label_rounding))+'-'+str(round(values[i],label_rounding))+' '+ax_units)
+    
+    # Sample the colormap at the centre of each isoline's share of its range, innermost isoline first
+    facecolors = cmap(1-(np.arange(len(ranges))+0.5)/len(ranges))
+    
+    # Plot isolines as a single collection
+    ax.add_collection(PathCollection(paths,
+                                     facecolors=facecolors,
+                                     edgecolors=rcParams['patch.edgecolor'],
+                                     linewidths=contour_lines,
+                                     transform=_GEODETIC,
+                                     alpha=alpha))
+    
+    # Legend handles, one per isoline. They are not added to the axes so they never draw or affect the data limits
+    return [Patch(facecolor=facecolor,
+                  edgecolor=rcParams['patch.edgecolor'],
+                  lw=contour_lines,
+                  alpha=alpha,
+                  label=label) for facecolor, label in zip(facecolors, labels)]
         
             
+def _nice_length(x):
+    '''
+    Rounds a positive length to 1 significant figure, then down to the nearest 1, 2 or 5 times a power of ten.
+    '''
+    ndim = int(np.floor(np.log10(x))) #number of digits in number
+    leading = round(x / 10 ** ndim) #leading digit after rounding to 1sf, 1 to 10
+    leading = _NICE_STEPS[bisect_right(_NICE_STEPS, leading) - 1]
+    return leading * 10 ** ndim
+
+@lru_cache(maxsize=32)
+def _transverse_mercator(central_longitude, central_latitude):
+    '''
+    Returns a cached TransverseMercator CRS centred on the given coords, so repeated scale bars reuse it.
+    '''
+    return ccrs.TransverseMercator(central_longitude, central_latitude)
+
 def scale_bar(ax, length=None, location=(0.5, 0.05), linewidth=3):
     """
     ax: matplotlib GeoAxesSubplot
@@ -212,12 +287,12 @@ def scale_bar(ax, length=None, location=(0.5, 0.05), linewidth=3):
     linewidth: thickness of the scalebar.
     """
     #Get the limits of the axis in lat long
-    llx0, llx1, lly0, lly1 = ax.get_extent(ccrs.PlateCarree())
+    llx0, llx1, lly0, lly1 = ax.get_extent(_PLATE_CARREE)
     #Make tmc horizontally centred on the middle of the map,
     #vertically at scale bar location
     sbllx = (llx1 + llx0) / 2
     sblly = lly0 + (lly1 - lly0) * location[1]
-    tmc = ccrs.TransverseMercator(sbllx, sblly)
+    tmc = _transverse_mercator(round(sbllx, 3), round(sblly, 3))
     #Get the extent of the plotted area in coordinates in metres
     x0, x1, y0, y1 = ax.get_extent(tmc)
     #Turn the specified scalebar location into coordinates in metres
@@ -225,16 +300,8 @@ def scale_bar(ax, length=None, location=(0.5, 0.05), linewidth=3):
     sby = y0 + (y1 - y0) * location[1]
 
     #Calculate a scale bar length if none has been given
-    #(Theres probably a more pythonic way of rounding the number but this works)
     if not length: 
-        length = (x1 - x0) / 5000 #in km
-        ndim = int(np.floor(np.log10(length))) #number of digits in number
-        length = round(length, -ndim) #round to 1sf
-        #Returns numbers starting with the list
-        def scale_number(x):
-            if str(x)[0] in ['1', '2', '5']: return int(x)        
-            else: return scale_number(x - 10 ** ndim)
-        length = scale_number(length) 
+        length = _nice_length((x1 - x0) / 5000) #in km
 
     #Generate the x coordinate for the ends of the scalebar
     bar_xs = [sbx - length * 500, sbx + length * 500]
@@ -250,19 +317,14 @@ def patch_between(poly1, poly2):
     poly1/poly2: numpy array with columns countain longitude and latitude coords. 
     '''
     
-    poly1_C = [Path.LINETO for p in poly1]
-    poly1_C[0] = Path.MOVETO
-    
-    poly2_C = [Path.LINETO for p in poly2]
-    poly2_C[0] = Path.MOVETO
-    
-    vertices = []
-    vertices.extend(poly1)
-    vertices.extend(poly2[::-1])
+    n1 = len(poly1)
+    vertices = np.empty((n1+len(poly2), 2))
+    vertices[:n1] = poly1
+    vertices[n1:] = poly2[::-1]
     
-    codes = []
-    codes.extend(poly1_C)
-    codes.extend(poly2_C)
+    codes = np.full(len(vertices), Path.LINETO, dtype=Path.code_type)
+    codes[0] = Path.MOVETO
+    codes[n1] = Path.MOVETO
     
     return Path(vertices, codes)
 
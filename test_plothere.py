@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import flexpolyline as fp
+
+from plothere import _decode_flexpolyline
+
+
+def reference_decode(encoded):
+    ''' Decodes with flexpolyline, returning lon/lat columns like _decode_flexpolyline. '''
+    points = list(fp.iter_decode(encoded))
+    return np.array([(p[1], p[0]) for p in points]).reshape(-1, 2)
+
+
+@pytest.mark.parametrize('third_dim', [fp.ABSENT, fp.ALTITUDE])
+@pytest.mark.parametrize('precision', [0, 5, 10, 15])
+def test_decode_matches_flexpolyline(precision, third_dim):
+    rng = np.random.default_rng(precision*10+third_dim)
+    for n in [1, 2, 50, 500]:
+        points = np.column_stack((rng.uniform(-90, 90, n), rng.uniform(-180, 180, n), rng.uniform(-100, 9000, n)))
+        points = [tuple(p) if third_dim else tuple(p[:2]) for p in points]
+        encoded = fp.encode(points, precision=precision, third_dim=third_dim, third_dim_precision=2)
+
+        np.testing.assert_array_equal(_decode_flexpolyline(encoded), reference_decode(encoded))
+
+
+def test_decode_header_only():
+    encoded = fp.encode([])
+
+    decoded = _decode_flexpolyline(encoded)
+
+    assert decoded.shape == (0, 2)
+    assert fp.decode(encoded) == []
+
+
+@pytest.mark.parametrize('encoded', [
+    fp.encode([(-43.5, 172.6), (-43.6, 172.7)])[:-1], # last value dropped
+    fp.encode([(-43.5, 172.6)])+'z', # continuation bit set on the final char
+    'BFoz5xéJ67i1B', # non-ascii char
+    'BFoz5x!J67i1B', # char outside the alphabet
+    'CFoz5xJ67i1B', # format version 2
+    'BF'+'z'*12+'AA', # value longer than 60 bits
+])
+def test_decode_invalid_raises_valueerror(encoded):
+    with pytest.raises(ValueError):
+        _decode_flexpolyline(encoded)